@@ -6,4 +6,4 @@ from pyncrypt.pyncrypt import KeyStore
 
 __author__ = """Mark Coggeshall"""
 __email__ = "mark.coggeshall@gmail.com"
-__version__ = '0.3.0'
+__version__ = '0.4.0'
@@ -4,20 +4,89 @@
 """Module for fetching/storing encrypted credentials from/to a local file."""
 
 import argparse
-import base64
 import dotenv
+import hashlib
+import hmac
+import logging
 import os
-import pickle
+import platform
+import sqlite3
+import stat
+import threading
+import time
 
 from getpass import getpass
-from pbkdf2 import PBKDF2
 from Crypto.Cipher import AES
-from Crypto import Random
+
+log = logging.getLogger(__name__)
+
+if not hasattr(hashlib, "scrypt"):
+    raise ImportError(
+        "pyncrypt requires hashlib.scrypt, which is only available when"
+        " Python is built against OpenSSL 1.1 or later."
+    )
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS secrets"
+    " (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+)
+
+# Result code SQLite reports when a file exists but is not a database
+_SQLITE_NOTADB = getattr(sqlite3, "SQLITE_NOTADB", 26)
+
+
+def _notadb(exc):
+    """Report whether an SQLite error means the file is not a database."""
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None:
+        return code == _SQLITE_NOTADB
+    return str(exc) == "file is not a database"
+
+
+def _have_aes_ni():
+    """Report whether pycryptodome can use the CPU's AES instructions.
+
+    Returns None if pycryptodome's CPU feature probe cannot be found.
+    pycryptodome picks AES-NI by itself, so this only serves to inform.
+    """
+    try:
+        from Crypto.Util._cpu_features import have_aes_ni
+    except ImportError:
+        return None
+    return bool(have_aes_ni())
+
+
+HAVE_AES_NI = _have_aes_ni()
+# AES-NI is an x86 extension, so its absence is only worth flagging there
+_X86 = platform.machine().lower() in ("x86_64", "amd64", "i386", "i686", "x86")
+if HAVE_AES_NI is False and _X86:
+    log.warning(
+        "AES-NI is unavailable; falling back to the slower table-based AES."
+    )
 
 
 class KeyStore(object):
     """Securely store/retrieve encrypted key-value pairs to/from files."""
 
+    # Settings that may be overridden by keyword argument at instantiation
+    _DEFAULTS = {
+        "passphrase_file": ".secrets_p",
+        "secretsdb_file": ".secrets",
+        # By default, secrets files can be read/written by user executing
+        # the script, read by the user's group, and are inaccessible to world.
+        # Because the database uses a WAL journal, other readers also need
+        # write access to its directory to create the -wal/-shm files.
+        "file_perm": 0o640,
+        "passphrase_size": 64,
+        "key_size": 32,
+        "iv_size": 16,
+        "tag_size": 16,
+        # scrypt cost parameters: CPU/memory cost, block size, parallelism
+        "kdf_cost": 2 ** 14,
+        "kdf_block_size": 8,
+        "kdf_parallelism": 1,
+    }
+
     def __init__(self, salt_seed=None, **kwargs):
         """Instantiate the class, define all required attributes.
 
@@ -28,76 +97,116 @@ class KeyStore(object):
         that is only useful for the duration of the current Python process
         (i.e., a one-time-use vault)."""
         if not salt_seed or len(salt_seed) == 0 or isinstance(salt_seed, str) is False:
-            self.salt_seed = self._urand2str(8)
+            self.salt_seed = os.urandom(8)
         else:
             self.salt_seed = salt_seed
-        self.passphrase_file = kwargs.get("passphrase_file") or ".secrets_p"
-        self.secretsdb_file = kwargs.get("secretsdb_file") or ".secrets"
-        # By default, secrets files can be read/written by user executing
-        # the script, read by the user's group, and are inaccessible to world.
-        self.file_perm = kwargs.get("file_perm") or 0o640
-        self.passphrase_size = kwargs.get("passphrase_size") or 64
-        self.key_size = kwargs.get("key_size") or 32
-        self.block_size = kwargs.get("block_size") or 16
-        self.iv_size = kwargs.get("iv_size") or 16
-        self.salt_size = kwargs.get("salt_size") or 8
-
-    def _dcode(self, bstring, encoding="utf-8"):
-        """Convert base64 bytes to UTF-8."""
-        return base64.b64encode(bstring).decode(encoding)
-
-    def _urand2str(self, nbytes, encoding="utf-8"):
-        """Return random bytes from cyptographically random pool."""
-        phrase = Random.new().read(nbytes)  # Random bytes
-        while len(phrase) % 3 != 0:
-            phrase += b"="
-        return self._dcode(phrase, encoding)
-
-    def _getsalt4key(self, key, salt=None, size=None):
-        """Given a key, return a salt."""
-        if not salt:
-            salt = self.salt_seed
-        if not size:
-            size = self.salt_size
-        return PBKDF2(key, salt).read(size)
-
-    def _encrypt(self, plaintext, salt):
-        """Pad plaintext, then encrypt using randomly initialized cipher.
-
-        NB: Strips trailing whitespace frome plaintext!
+        for name, default in self._DEFAULTS.items():
+            setattr(self, name, kwargs.get(name) or default)
+        # HMAC keyed with the scrypt-stretched passphrase, and the cipher
+        # keys derived from it per logical key name. Both are only valid for
+        # as long as the passphrase file is left unchanged.
+        self._master_hmac = None
+        self._kdf_cache = {}
+        self._passphrase = None
+        self._passphrase_mtime = None
+        # Connection to the secrets database, opened on first use and shared
+        # by all threads; the lock serialises its use. Commits are deferred
+        # while the KeyStore is used as a context manager.
+        self._conn = None
+        self._dirty = False
+        self._depth = 0
+        self._perm_checked = False
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        """Defer writes to the secrets database until the block exits."""
+        with self._lock:
+            self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Commit pending changes, or discard them if the block raised."""
+        with self._lock:
+            self._depth -= 1
+            if self._depth == 0:
+                if exc_type is None:
+                    self.flush()
+                else:
+                    self._rollback()
+        return False
+
+    def _tobytes(self, value, encoding="utf-8"):
+        """Return value as bytes, encoding it first if it is a string."""
+        if isinstance(value, str):
+            return value.encode(encoding)
+        return value
+
+    def _stretch(self, secret):
+        """Stretch a secret into a key_size key with scrypt and salt_seed."""
+        # scrypt needs roughly 128 * r * (n + p) bytes of working memory
+        blocks = self.kdf_cost + self.kdf_parallelism
+        maxmem = 256 * self.kdf_block_size * blocks
+        return hashlib.scrypt(
+            self._tobytes(secret),
+            salt=self._tobytes(self.salt_seed),
+            n=self.kdf_cost,
+            r=self.kdf_block_size,
+            p=self.kdf_parallelism,
+            maxmem=maxmem,
+            dklen=self.key_size,
+        )
+
+    def _derive_key(self, key):
+        """Given a key, return the cipher key derived for it.
+
+        The passphrase is stretched with scrypt only once; each key's cipher
+        key is then an HMAC of the key name under that master key.
         """
+        passphrase = self._getsetphrase()
+        try:
+            return self._kdf_cache[key]
+        except KeyError:
+            if self._master_hmac is None:
+                master = self._stretch(passphrase)
+                self._master_hmac = hmac.new(master, digestmod=hashlib.sha256)
+            # Copying reuses the inner/outer pad state already keyed above
+            mac = self._master_hmac.copy()
+            mac.update(self._tobytes(key))
+            self._kdf_cache[key] = mac.digest()[: self.key_size]
+            return self._kdf_cache[key]
+
+    def _cipher(self, key, iv):
+        """Return a new AES-GCM cipher for key and nonce."""
+        return AES.new(key, AES.MODE_GCM, nonce=iv, mac_len=self.tag_size)
+
+    def _encrypt(self, plaintext, key):
+        """Encrypt and authenticate plaintext using a random nonce."""
         if hasattr(plaintext, "decode"):
             raise TypeError("Please pass a string value, not bytes.")
         # Initialize cipher randomly
-        iv = Random.new().read(self.iv_size)
-        passphrase = self._getsetphrase()
-        # Prepare cipher key
-        key = self._getsalt4key(passphrase, salt, size=self.key_size)
-        # Pad and encrypt
-        mplyr = self.block_size - (len(plaintext) % self.block_size)
-        cipher = AES.new(key, AES.MODE_CFB, iv)
-        payload = plaintext + (r" " * mplyr)
-        safesecret = cipher.encrypt(payload.encode("utf-8"))
-        return iv + safesecret
-
-    def _decrypt(self, ciphertext, salt):
-        """Reconstruct the cipher object and decrypt.
-
-        NB: Strips trailing whitespace from the retrieved value!
-        """
-        passphrase = self._getsetphrase()
-        # Prepare cipher key:
-        key = self._getsalt4key(passphrase, salt, size=self.key_size)
-        # Reconstruct cipher (IV need not be identical to encrypt version)
-        iv = Random.new().read(self.iv_size)
-        cipher = AES.new(key, AES.MODE_CFB, iv)
-        cleartext = cipher.decrypt(ciphertext)[len(iv) :]
+        iv = os.urandom(self.iv_size)
+        cipher = self._cipher(key, iv)
+        # GCM is a stream mode, so the plaintext needs no padding
+        safesecret, tag = cipher.encrypt_and_digest(plaintext.encode("utf-8"))
+        return iv + tag + safesecret
+
+    def _decrypt(self, ciphertext, key):
+        """Reconstruct the cipher object, then decrypt and verify."""
+        # Reconstruct cipher from the IV and tag stored ahead of the
+        # ciphertext, slicing through a memoryview to avoid copying it
+        record = memoryview(ciphertext)
+        split = self.iv_size + self.tag_size
+        cipher = self._cipher(key, record[: self.iv_size])
         try:
-            retval = cleartext.decode().rstrip(r" ")
-        except UnicodeDecodeError:
+            cleartext = cipher.decrypt_and_verify(
+                record[split:], record[self.iv_size : split]
+            )
+            retval = cleartext.decode()
+        except (ValueError, UnicodeDecodeError):
             emsg = (
                 "Value cannot be decoded. The passphrase used to"
-                " initiate the KeyStore has likely changed. Correct"
+                " initiate the KeyStore has likely changed, or the"
+                " stored value has been tampered with. Correct"
                 " the passphrase to its original value or delete the"
                 " KeyStore and store new values within it."
             )
@@ -106,99 +215,266 @@ class KeyStore(object):
 
     def _getphrase(self):
         """Getter for passphrase."""
-        with open(self.passphrase_file, "r") as fle:
+        with open(self.passphrase_file, "rb") as fle:
             return fle.read()
 
-    def _setphrase(self):
-        """Setter for passphrase."""
-        with open(self.passphrase_file, "w") as fle:
-            os.chmod(self.passphrase_file, self.file_perm)
-            fle.write(self._urand2str(self.passphrase_size))
+    def _enforceperm(self, target):
+        """Give a file owned by this user file_perm.
+
+        target may be a path or an open file descriptor. Files owned by
+        someone else, e.g. a vault shared with the group, are left alone.
+        """
+        st = os.stat(target)
+        if st.st_uid != os.getuid():
+            return None
+        if stat.S_IMODE(st.st_mode) != self.file_perm:
+            os.chmod(target, self.file_perm)
+        return None
+
+    def _openw(self, path, flags=os.O_TRUNC):
+        """Open path for binary writing with file_perm.
+
+        Passing the mode to os.open means a new file never exists with looser
+        permissions than file_perm, as it would between open() and chmod().
+        That mode only applies on creation, so it is also enforced on the
+        open descriptor to cover a file that already existed.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | flags, self.file_perm)
         try:
-            # If the passphrase has to be regenerated, then the old secrets
-            # file is irretrievable and should be removed
-            if os.path.exists(self.secretsdb_file):
-                os.remove(self.secretsdb_file)
-        except:
+            self._enforceperm(fd)
+        except BaseException:
+            os.close(fd)
             raise
+        return os.fdopen(fd, "wb")
+
+    def _setphrase(self):
+        """Setter for passphrase."""
+        with self._openw(self.passphrase_file) as fle:
+            fle.write(os.urandom(self.passphrase_size))
+        # If the passphrase has to be regenerated, then the old secrets
+        # file is irretrievable and should be removed
+        if self._dirty:
+            log.warning(
+                "Passphrase file %s is missing; discarding uncommitted"
+                " changes to %s.",
+                self.passphrase_file,
+                self.secretsdb_file,
+            )
+        self._closedb()
+        self._removedb()
         return None
 
     def _getsetphrase(self):
-        """Get/Set brancher for passphrase."""
-        if os.path.exists(self.passphrase_file):
-            passphrase = self._getphrase()
-        else:
+        """Get/Set brancher for passphrase.
+
+        The passphrase is only re-read, and derived keys discarded, when the
+        passphrase file has been replaced since it was last loaded.
+        """
+        try:
+            mtime = os.stat(self.passphrase_file).st_mtime_ns
+        except FileNotFoundError:
             self._setphrase()
-            passphrase = self._getphrase()
-        return passphrase
+            mtime = os.stat(self.passphrase_file).st_mtime_ns
+        if mtime != self._passphrase_mtime:
+            self._passphrase = self._getphrase()
+            self._master_hmac = None
+            self._kdf_cache.clear()
+            self._passphrase_mtime = mtime
+        return self._passphrase
+
+    def _getsetdb(self, replace=True):
+        """Open or create secrets database.
 
-    def _getsetdb(self):
-        """Load or create secrets database."""
+        A file that SQLite reports is not a database at all (e.g. one
+        written by an older version) is moved aside and a new database
+        started in its place. Any other error, such as a locked or
+        unopenable database, is raised unchanged.
+        """
+        # Create a missing file up front so that it has file_perm; SQLite
+        # gives journal files it creates the same mode. An existing file is
+        # only brought to file_perm before it is first written.
+        if not os.path.exists(self.secretsdb_file):
+            try:
+                self._openw(self.secretsdb_file, flags=os.O_EXCL).close()
+            except FileExistsError:
+                pass
+        conn = sqlite3.connect(self.secretsdb_file, check_same_thread=False)
         try:
-            with open(self.secretsdb_file, "rb") as fle:
-                dbs = pickle.load(fle)
-        except (IOError, EOFError, TypeError):
-            dbs = {}
-            self._pickledb(dbs)
-        return dbs
-
-    def _pickledb(self, thedict):
-        with open(self.secretsdb_file, "wb") as fle:
-            os.chmod(self.secretsdb_file, self.file_perm)
-            pickle.dump(thedict, fle)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+        except sqlite3.DatabaseError as exc:
+            conn.close()
+            operational = isinstance(exc, sqlite3.OperationalError)
+            if operational or not replace or not _notadb(exc):
+                raise
+            aside = self._moveasidedb()
+            log.warning(
+                "Secrets database %s is not a database; moved it to %s and"
+                " started a new one.",
+                self.secretsdb_file,
+                aside,
+            )
+            return self._getsetdb(replace=False)
+        return conn
+
+    @property
+    def _db(self):
+        """Connection to the secrets database, opened once and kept open."""
+        if self._conn is None:
+            self._conn = self._getsetdb()
+        return self._conn
+
+    def _closedb(self):
+        """Close the connection to the secrets database, if open."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._dirty = False
+        self._perm_checked = False
+        return None
+
+    def _moveasidedb(self):
+        """Move the secrets database and journal files to an unused name.
+
+        Hard-linking, then unlinking, never overwrites an existing file, so
+        an earlier aside copy cannot be lost.
+        """
+        stamp = "%s.unreadable-%d-%d" % (
+            self.secretsdb_file,
+            time.time(),
+            os.getpid(),
+        )
+        attempt = 0
+        while True:
+            aside = "%s-%d" % (stamp, attempt)
+            try:
+                os.link(self.secretsdb_file, aside)
+                break
+            except FileExistsError:
+                attempt += 1
+        os.remove(self.secretsdb_file)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.secretsdb_file + suffix):
+                os.link(self.secretsdb_file + suffix, aside + suffix)
+                os.remove(self.secretsdb_file + suffix)
+        return aside
+
+    def _removedb(self):
+        """Remove the secrets database and any SQLite journal files."""
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.secretsdb_file + suffix):
+                os.remove(self.secretsdb_file + suffix)
+        return None
+
+    def _fetch(self, key):
+        """Return the encrypted value stored for key, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM secrets WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _touchdb(self):
+        """Mark the secrets database as changed and commit unless deferred."""
+        if not self._perm_checked:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.secretsdb_file + suffix):
+                    self._enforceperm(self.secretsdb_file + suffix)
+            self._perm_checked = True
+        self._dirty = True
+        if self._depth == 0:
+            self.flush()
+        return None
+
+    def flush(self):
+        """Commit pending changes to the secrets database."""
+        with self._lock:
+            if self._dirty:
+                self._conn.commit()
+                self._dirty = False
+        return None
+
+    def _rollback(self):
+        """Discard pending changes to the secrets database."""
+        with self._lock:
+            if self._dirty:
+                self._conn.rollback()
+                self._dirty = False
+        return None
+
+    def close(self):
+        """Commit pending changes and close the secrets database."""
+        with self._lock:
+            self.flush()
+            self._closedb()
         return None
 
     def store(self, key, value):
         """Store key-value pair safely and save to disk."""
-        dbs = self._getsetdb()
-        dbs[key] = self._encrypt(value, self._getsalt4key(key))
-        self._pickledb(dbs)
+        with self._lock:
+            aes_key = self._derive_key(key)
+            self._db.execute(
+                "INSERT OR REPLACE INTO secrets (key, value) VALUES (?, ?)",
+                (key, self._encrypt(value, aes_key)),
+            )
+            self._touchdb()
+        return None
+
+    def store_many(self, items):
+        """Store several key-value pairs, saving to disk only once."""
+        with self:
+            for key, value in items.items():
+                self.store(key, value)
         return None
 
     def retrieve(self, key):
         """Fetch key-value pair."""
-        dbs = self._getsetdb()
-        return self._decrypt(dbs[key], self._getsalt4key(key))
+        with self._lock:
+            aes_key = self._derive_key(key)
+            ciphertext = self._fetch(key)
+        if ciphertext is None:
+            raise KeyError(key)
+        return self._decrypt(ciphertext, aes_key)
+
+    def retrieve_many(self, keys):
+        """Fetch several key-value pairs as a dict."""
+        return {key: self.retrieve(key) for key in keys}
 
     def require(self, key):
         """Test if key is stored, if not, prompt the user for it.
 
         Hide their input from shoulder-surfers.
         """
-        dbs = self._getsetdb()
-        if key not in dbs:
+        if self._fetch(key) is None:
             self.store(key, getpass('Enter a value for "%s":' % key))
         return self.retrieve(key)
 
     def remove(self, key):
         """Remove a specific key from the store.
 
-        If the key does not exist, catch the error silently.
+        If the key does not exist, ignore it silently.
         """
-        dbs = self._getsetdb()
-        try:
-            val = dbs.pop(key)
-            del val
-        except KeyError:
-            pass
-        self._pickledb(dbs)
+        with self._lock:
+            cur = self._db.execute("DELETE FROM secrets WHERE key = ?", (key,))
+            if cur.rowcount == 0:
+                return None
+            self._touchdb()
         return None
 
     def clear(self):
         """Remove ALL key-value pairs from the store."""
-        dbs = self._getsetdb()
-        dbs.clear()
-        self._pickledb(dbs)
+        with self._lock:
+            self._db.execute("DELETE FROM secrets")
+            self._touchdb()
         return None
 
     def destroy(self):
         """Remove ALL key-value pairs from the store and remove the files."""
-        try:
+        with self._lock:
             self.clear()
-            os.remove(self.secretsdb_file)
+            self._closedb()
+            self._removedb()
             os.remove(self.passphrase_file)
-        except:
-            raise
         return None
 
 
@@ -13,7 +13,6 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'python-dotenv>=0.5.1',
-    'pbkdf2>=1.3',
     'pycryptodome>=3.9.9'
 ]
 
@@ -29,7 +28,7 @@ test_requirements = [
 
 setup(
     name='pyncrypt',
-    version='0.3.0',
+    version='0.4.0',
     description="Create, maintain, and use encrypted key-value stores",
     long_description=readme + '\n\n' + history,
     author="Mark Coggeshall",
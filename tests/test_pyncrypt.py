@@ -3,13 +3,25 @@
 
 """Tests for `pyncrypt` package."""
 
+import functools
+import os
+import sqlite3
+import stat
+import threading
+
 import pytest
 
 
 from pyncrypt import pyncrypt
 
 
-VALLST = ["feefifofum", "1Y#⁄€Ü—&bw!", "mechaLechahiMECKAHINIEho"]
+VALLST = [
+    "feefifofum",
+    "1Y#⁄€Ü—&bw!",
+    "mechaLechahiMECKAHINIEho",
+    "trailing whitespace  ",
+    "sixteen bytes ok",
+]
 
 
 @pytest.fixture(scope="module", params=VALLST)
@@ -21,6 +33,23 @@ def onetimevault(request):
     vault.destroy()
 
 
+@pytest.fixture
+def settings(tmp_path):
+    """Keep a KeyStore's files in a per-test temporary directory."""
+    return dict(
+        passphrase_file=str(tmp_path / "secrets_p"),
+        secretsdb_file=str(tmp_path / "secrets"),
+    )
+
+
+@pytest.fixture
+def vault(settings):
+    """Create a vault whose files live in a temporary directory."""
+    vault = pyncrypt.KeyStore("saltseed", **settings)
+    yield vault
+    vault.close()
+
+
 def test_retrieve(onetimevault, key="foobar"):
     """Retrieve a key-value pair from the vault."""
     vault = onetimevault
@@ -31,3 +60,183 @@ def test_require(onetimevault, key="foobar"):
     """Retrieve a key-value pair from the vault."""
     vault = onetimevault
     assert vault.require(key) in VALLST
+
+
+def test_context_defers_writes(vault, settings):
+    """Write the secrets database once, when the with-block exits."""
+    count = "SELECT COUNT(*) FROM secrets"
+    with vault:
+        for val in VALLST:
+            vault.store(key=val, value=val)
+        observer = sqlite3.connect(settings["secretsdb_file"])
+        assert observer.execute(count).fetchone() == (0,)
+    assert observer.execute(count).fetchone() == (len(VALLST),)
+    observer.close()
+    reopened = pyncrypt.KeyStore("saltseed", **settings)
+    assert [reopened.retrieve(val) for val in VALLST] == VALLST
+
+
+@pytest.mark.parametrize("value", VALLST)
+def test_tampered_value_rejected(vault, value, key="foobar"):
+    """Refuse to return a value whose ciphertext has been altered."""
+    vault.store(key=key, value=value)
+    original = vault._fetch(key)
+    tampered = original[:-1] + bytes([original[-1] ^ 1])
+    update = "UPDATE secrets SET value = ? WHERE key = ?"
+    vault._db.execute(update, (tampered, key))
+    vault._db.commit()
+    with pytest.raises(ValueError):
+        vault.retrieve(key)
+
+
+def test_file_permissions(settings):
+    """Create the passphrase and secrets files with file_perm."""
+    vault = pyncrypt.KeyStore("saltseed", file_perm=0o600, **settings)
+    vault.store(key="foobar", value=VALLST[0])
+    for path in (vault.passphrase_file, vault.secretsdb_file):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_file_permissions_existing(settings):
+    """Apply file_perm to an existing secrets database before writing."""
+    vault = pyncrypt.KeyStore("saltseed", file_perm=0o644, **settings)
+    vault.store(key="foobar", value=VALLST[0])
+    vault.close()
+    reopened = pyncrypt.KeyStore("saltseed", file_perm=0o600, **settings)
+    path = settings["secretsdb_file"]
+    assert reopened.retrieve("foobar") == VALLST[0]
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    reopened.store(key="foobar", value=VALLST[1])
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_store_many(vault):
+    """Store and retrieve several key-value pairs at once."""
+    items = {str(idx): val for idx, val in enumerate(VALLST)}
+    vault.store_many(items)
+    assert not vault._dirty
+    assert vault.retrieve_many(items) == items
+
+
+def test_locked_db_survives(vault, settings, monkeypatch):
+    """Raise on a locked secrets database instead of replacing it."""
+    vault.store(key="foobar", value=VALLST[0])
+    vault.close()
+    locker = sqlite3.connect(settings["secretsdb_file"], isolation_level=None)
+    locker.execute("PRAGMA locking_mode=EXCLUSIVE")
+    locker.execute("BEGIN EXCLUSIVE")
+    locker.execute("DELETE FROM secrets WHERE key = 'nonesuch'")
+    quick_connect = functools.partial(sqlite3.connect, timeout=0.1)
+    monkeypatch.setattr(pyncrypt.sqlite3, "connect", quick_connect)
+    blocked = pyncrypt.KeyStore("saltseed", **settings)
+    with pytest.raises(sqlite3.OperationalError):
+        blocked.retrieve("foobar")
+    locker.close()
+    assert blocked.retrieve("foobar") == VALLST[0]
+
+
+def test_unreadable_db_moved_aside(vault, settings, tmp_path):
+    """Move a file that is not a database aside rather than deleting it."""
+    vault.store(key="foobar", value=VALLST[0])
+    vault.close()
+    junk = b"not an sqlite database" * 10
+    with open(settings["secretsdb_file"], "wb") as fle:
+        fle.write(junk)
+    reopened = pyncrypt.KeyStore("saltseed", **settings)
+    with pytest.raises(KeyError):
+        reopened.retrieve("foobar")
+    (aside,) = tmp_path.glob("secrets.unreadable-*")
+    assert aside.read_bytes() == junk
+    reopened.close()
+    with open(settings["secretsdb_file"], "wb") as fle:
+        fle.write(junk[::-1])
+    second = pyncrypt.KeyStore("saltseed", **settings)
+    with pytest.raises(KeyError):
+        second.retrieve("foobar")
+    asides = tmp_path.glob("secrets.unreadable-*")
+    assert sorted(p.read_bytes() for p in asides) == sorted([junk, junk[::-1]])
+
+
+def test_store_many_rolls_back(vault):
+    """Store nothing from a batch that fails partway through."""
+    vault.store(key="kept", value=VALLST[0])
+    items = {
+        "first": VALLST[1],
+        "bad": b"bytes are rejected",
+        "last": VALLST[2],
+    }
+    with pytest.raises(TypeError):
+        vault.store_many(items)
+    assert not vault._dirty
+    assert vault._fetch("first") is None
+    assert vault.retrieve("kept") == VALLST[0]
+
+
+def test_lost_passphrase_logged(vault, caplog):
+    """Warn when a missing passphrase discards uncommitted changes."""
+    with vault:
+        vault.store(key="foobar", value=VALLST[0])
+        os.remove(vault.passphrase_file)
+        vault.store(key="foobaz", value=VALLST[1])
+    assert "discarding uncommitted changes" in caplog.text
+    assert vault._fetch("foobar") is None
+    assert vault.retrieve("foobaz") == VALLST[1]
+
+
+def test_retrieve_missing(onetimevault):
+    """Raise KeyError for a key that was never stored."""
+    with pytest.raises(KeyError):
+        onetimevault.retrieve("nonesuch")
+
+
+def test_remove(vault):
+    """Remove one key, and ignore a key that is not stored."""
+    vault.store_many({"foobar": VALLST[0], "foobaz": VALLST[1]})
+    with vault:
+        vault.remove("nonesuch")
+        assert not vault._dirty
+        vault.remove("foobar")
+        assert vault._dirty
+    assert vault._fetch("foobar") is None
+    assert vault.retrieve("foobaz") == VALLST[1]
+
+
+def test_clear(vault):
+    """Remove every key-value pair but keep the store usable."""
+    vault.store_many({"foobar": VALLST[0], "foobaz": VALLST[1]})
+    vault.clear()
+    assert vault.retrieve_many([]) == {}
+    assert vault._fetch("foobar") is None
+    assert vault._fetch("foobaz") is None
+
+
+def test_close(vault, settings):
+    """Commit pending changes on close and reopen on next use."""
+    with vault:
+        vault.store(key="foobar", value=VALLST[0])
+        vault.close()
+        assert vault._conn is None
+    reopened = pyncrypt.KeyStore("saltseed", **settings)
+    assert reopened.retrieve("foobar") == VALLST[0]
+    assert vault.retrieve("foobar") == VALLST[0]
+
+
+def test_destroy(vault, tmp_path):
+    """Remove the passphrase, database, and journal files."""
+    vault.store(key="foobar", value=VALLST[0])
+    vault.destroy()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_retrieve_other_thread(vault):
+    """Retrieve from a thread other than the one that stored the value."""
+    vault.store(key="foobar", value=VALLST[0])
+    found = []
+
+    def retrieve():
+        found.append(vault.retrieve("foobar"))
+
+    worker = threading.Thread(target=retrieve)
+    worker.start()
+    worker.join()
+    assert found == [VALLST[0]]